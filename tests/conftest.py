@@ -13,6 +13,17 @@ import sys
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 
+@pytest.fixture(autouse=True)
+def reset_registry_state():
+    """Reset per-process registry caches, since paths are relative to the cwd"""
+    for module_name in ("tools.prompt_registry", "prompt_registry"):
+        module = sys.modules.get(module_name)
+        if module is not None:
+            module._reset_db()
+            module._resolve_default.cache_clear()
+    yield
+
+
 @pytest.fixture
 def temp_workspace():
     """Create a temporary workspace for tests"""
@@ -3,15 +3,17 @@ Tests for Shippopotamus PromptOps platform
 """
 
 import os
+import sqlite3
 import tempfile
+from datetime import datetime
 from pathlib import Path
 import pytest
 import sys
 from unittest.mock import patch, Mock
 sys.path.append('..')
 
-from tools.prompt_registry import get_prompt, save_prompt, load_prompts, init_db
-from tools.prompt_composer import compose_prompts, list_available, estimate_context, bootstrap_session
+from tools.prompt_registry import get_prompt, save_prompt, load_prompts, init_db, estimate_tokens, connect_db, _reset_db, _resolve_default
+from tools.prompt_composer import compose_prompts, list_available, estimate_context, bootstrap_session, _compose_cached
 
 
 class TestPromptRegistry:
@@ -29,6 +31,47 @@ class TestPromptRegistry:
         # In real usage, these files exist in the package
         result = get_prompt("nonexistent")
         assert "error" in result
+
+    def test_unknown_names_not_cached(self):
+        """Test lookups of non-default names do not grow the resolver cache"""
+        for i in range(50):
+            get_prompt(f"typo_{i}")
+
+        assert _resolve_default.cache_info().currsize == 0
+
+    def test_usage_log_text_timestamps_migrated(self):
+        """Test a pre-epoch usage_log is converted to REAL epoch seconds"""
+        conn = sqlite3.connect("tmp/prompt_registry.db")
+        conn.execute("DROP TABLE usage_log")
+        conn.execute("""
+            CREATE TABLE usage_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                prompt_name TEXT NOT NULL,
+                prompt_type TEXT NOT NULL,
+                used_at TEXT NOT NULL,
+                tokens INTEGER
+            )
+        """)
+        conn.executemany(
+            "INSERT INTO usage_log (prompt_name, prompt_type, used_at, tokens) VALUES (?, ?, ?, ?)",
+            [("old", "custom", "2025-01-02T03:04:05.500000", 1),
+             ("new", "custom", 1760000000.25, 1)]
+        )
+        conn.commit()
+        conn.close()
+
+        _reset_db()
+        init_db()
+
+        conn = sqlite3.connect("tmp/prompt_registry.db")
+        rows = dict(conn.execute("SELECT prompt_name, used_at FROM usage_log").fetchall())
+        column_types = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(usage_log)")}
+        conn.close()
+
+        assert column_types["used_at"] == "REAL"
+        expected = datetime.fromisoformat("2025-01-02T03:04:05.500000").timestamp()
+        assert rows["old"] == pytest.approx(expected, abs=0.01)
+        assert rows["new"] == 1760000000.25
     
     def test_save_and_get_custom_prompt(self):
         """Test saving and retrieving custom prompts"""
@@ -111,6 +154,41 @@ class TestPromptLoading:
         assert "custom:prompt2" in refs
         assert "file:external.md" in refs
     
+    def test_load_counts_usage_per_ref(self):
+        """Test batched loads still count every custom prompt use"""
+        load_prompts(["prompt1", "custom:prompt1", "prompt2", "nonexistent"])
+
+        usage = {p["name"]: p["usage_count"] for p in list_available()["custom"]}
+        assert usage == {"prompt1": 2, "prompt2": 1}
+    
+    def test_load_file_sees_edits(self):
+        """Test file refs are re-read once the file changes"""
+        first = load_prompts(["file:external.md"])
+        Path("external.md").write_text("Edited external content")
+        second = load_prompts(["file:external.md"])
+
+        assert first["loaded"][0]["content"] == "External content"
+        assert second["loaded"][0]["content"] == "Edited external content"
+    
+    def test_load_closes_connection_on_error(self):
+        """Test a failing load still closes its database connection"""
+        conn = sqlite3.connect("tmp/prompt_registry.db")
+        conn.execute("UPDATE custom_prompts SET tags = 'not json' WHERE name = 'prompt1'")
+        conn.commit()
+        conn.close()
+
+        opened = []
+        def tracking_connect():
+            opened.append(connect_db())
+            return opened[-1]
+
+        with patch("tools.prompt_registry.connect_db", tracking_connect):
+            with pytest.raises(ValueError):
+                load_prompts(["prompt1"])
+
+        with pytest.raises(sqlite3.ProgrammingError):
+            opened[0].execute("SELECT 1")
+    
     def test_load_with_errors(self):
         """Test loading with some failures"""
         result = load_prompts([
@@ -152,7 +230,62 @@ class TestPromptComposition:
         assert "content" in result
         assert result["content"].count("Shared paragraph") == 1
         assert len(result["metadata"]["removed_duplicates"]) > 0
-    
+
+    def test_compose_dedup_keeps_separator(self):
+        """Test deduplicated output still separates source prompts"""
+        result = compose_prompts(["base", "extension"], deduplicate=True, separator="\n===\n")
+
+        assert result["content"] == "Base content\n\nShared paragraph\n===\nExtension content"
+
+    def test_compose_file_refs_cached_until_modified(self):
+        """Test file-backed compositions are reused until the file changes"""
+        Path("cached.md").write_text("First version")
+
+        first = compose_prompts(["file:cached.md"])
+        hits = _compose_cached.cache_info().hits
+        again = compose_prompts(["file:cached.md"])
+        assert _compose_cached.cache_info().hits == hits + 1
+        assert again["content"] == first["content"] == "First version"
+
+        Path("cached.md").write_text("Second version, longer")
+        misses = _compose_cached.cache_info().misses
+        updated = compose_prompts(["file:cached.md"])
+        assert _compose_cached.cache_info().misses == misses + 1
+        assert updated["content"] == "Second version, longer"
+
+    def test_compose_cached_result_is_isolated(self):
+        """Test mutating a returned composition does not leak into the cache"""
+        Path("cached.md").write_text("Original content")
+
+        result = compose_prompts(["file:cached.md"])
+        result["sources"][0]["content"] = "HACKED"
+        result["metadata"]["sources"].append("junk")
+
+        again = compose_prompts(["file:cached.md"])
+        assert again["sources"][0]["content"] == "Original content"
+        assert len(again["metadata"]["sources"]) == 1
+
+    def test_compose_counts_custom_usage_once(self):
+        """Test uncached compositions log each custom prompt exactly once"""
+        compose_prompts(["base", "extension"])
+
+        usage = {p["name"]: p["usage_count"] for p in list_available()["custom"]}
+        assert usage == {"base": 1, "extension": 1}
+
+    def test_compose_cache_hit_logs_usage(self):
+        """Test cached compositions are still counted in usage_log"""
+        Path("cached.md").write_text("Logged content")
+
+        compose_prompts(["file:cached.md"])
+        compose_prompts(["file:cached.md"])
+
+        conn = sqlite3.connect("tmp/prompt_registry.db")
+        rows = conn.execute(
+            "SELECT prompt_type FROM usage_log WHERE prompt_name = ?", ("cached.md",)
+        ).fetchall()
+        conn.close()
+        assert rows == [("file",), ("file",)]
+
     def test_compose_with_token_limit(self):
         """Test composition with token limit"""
         # Create a large prompt
@@ -166,6 +299,38 @@ class TestPromptComposition:
         assert result["tokens"] <= 100
         assert "trimmed" in result["metadata"]
 
+    def test_compose_tokens_match_deduplicated_content(self):
+        """Test token counts reflect whitespace dropped while deduplicating"""
+        save_prompt(name="spaced", content="Para one\n\n\n\n   Para two   \n\nShared")
+        save_prompt(name="beta", content="Shared\n\nBeta")
+
+        result = compose_prompts(["spaced", "beta"], deduplicate=True)
+
+        assert result["tokens"] == estimate_tokens(result["content"])
+
+    def test_compose_reported_tokens_fit_as_budget(self):
+        """Test a composition fits a budget equal to its own token count"""
+        Path("many.md").write_text("abcde\n\n" + "\n\n".join(f"x{i}" for i in range(20)))
+
+        full = compose_prompts(["file:many.md"])
+        budgeted = compose_prompts(["file:many.md"], max_tokens=full["tokens"])
+
+        assert budgeted["content"] == full["content"]
+        assert "trimmed" not in budgeted["metadata"]
+
+    def test_compose_budget_skips_oversized_prompt(self):
+        """Test a prompt over budget is dropped without losing later ones"""
+        save_prompt(name="big", content="x" * 1000)
+        save_prompt(name="small", content="small one")
+
+        result = compose_prompts(["big", "small"], max_tokens=50, deduplicate=False)
+
+        assert result["content"] == "small one"
+        trimmed = result["metadata"]["trimmed"]
+        assert trimmed["kept_prompts"] == 1
+        assert trimmed["dropped_prompts"] == 1
+        assert trimmed["kept_tokens"] == result["tokens"]
+
 
 class TestUtilities:
     """Test utility functions"""
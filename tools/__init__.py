@@ -5,14 +5,12 @@ A prompt management platform for AI applications.
 Provides tools to load, save, compose, and manage prompts efficiently.
 """
 
-from fastmcp import FastMCP
-
 # Import all tool modules
 from . import prompt_registry
 from . import prompt_composer
 
-# Create a single MCP instance for all tools
-mcp = FastMCP()
+# The single MCP instance shared by all tools
+from ._mcp import mcp
 
 # Tools are registered via @mcp.tool() decorators in their modules
 
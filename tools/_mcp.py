@@ -0,0 +1,9 @@
+"""
+Shared FastMCP instance for Shippopotamus tools.
+
+Every tool module registers on this one server via @mcp.tool().
+"""
+
+from fastmcp import FastMCP
+
+mcp = FastMCP()
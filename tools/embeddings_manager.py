@@ -3,6 +3,7 @@ Embeddings manager for semantic prompt discovery.
 Handles embedding generation, storage, and similarity search.
 """
 
+import heapq
 import json
 import sqlite3
 from pathlib import Path
@@ -18,16 +19,15 @@ try:
 except ImportError:
     HAS_SENTENCE_TRANSFORMERS = False
 
-from fastmcp import FastMCP
 try:
+    from ._mcp import mcp
     from .prompt_registry import DB_PATH, init_db, get_default_prompt
     from .prompt_composer import compose_prompts
 except ImportError:
+    from _mcp import mcp
     from prompt_registry import DB_PATH, init_db, get_default_prompt
     from prompt_composer import compose_prompts
 
-mcp = FastMCP()
-
 # Constants
 EMBEDDING_MODEL = "all-MiniLM-L6-v2"  # Small, fast, good for semantic similarity
 EMBEDDING_DIM = 384  # Dimension for all-MiniLM-L6-v2
@@ -117,15 +117,19 @@ class EmbeddingsManager:
     def store_embedding(self, prompt_id: str, prompt_type: str, 
                        embedding: List[float], content_hash: str):
         """Store embedding in database."""
+        self.store_embeddings([(prompt_id, prompt_type, embedding, content_hash)])
+    
+    def store_embeddings(self, entries: List[Tuple[str, str, List[float], str]]):
+        """Store (prompt_id, prompt_type, embedding, content_hash) entries in one transaction."""
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
         
-        cursor.execute("""
+        cursor.executemany("""
             INSERT OR REPLACE INTO prompt_embeddings 
             (prompt_id, prompt_type, embedding_json, content_hash, model_name)
             VALUES (?, ?, ?, ?, ?)
-        """, (prompt_id, prompt_type, json.dumps(embedding), 
-              content_hash, self.model_name))
+        """, [(prompt_id, prompt_type, json.dumps(embedding), content_hash, self.model_name)
+              for prompt_id, prompt_type, embedding, content_hash in entries])
         
         conn.commit()
         conn.close()
@@ -191,9 +195,8 @@ class EmbeddingsManager:
         
         conn.close()
         
-        # Sort by similarity and return top_k
-        results.sort(key=lambda x: x['similarity'], reverse=True)
-        return results[:top_k]
+        # Return the top_k most similar without sorting every candidate
+        return heapq.nlargest(top_k, results, key=lambda x: x['similarity'])
     
     def _ensure_indexed(self):
         """Ensure all prompts are indexed before searching."""
@@ -218,18 +221,21 @@ class EmbeddingsManager:
         from prompt_registry import default_prompts
         import hashlib
         
+        # Collected and written in a single transaction at the end
+        entries = []
+        
         # Index default prompts
         for prompt_name, prompt_path in default_prompts.items():
             try:
                 prompt_data = get_default_prompt(prompt_name)
                 if prompt_data:
                     content = prompt_data['content']
-                    content_hash = hashlib.sha256(content.encode()).hexdigest()[:16]
+                    content_hash = hashlib.blake2b(content.encode(), digest_size=8).hexdigest()
                     
-                    # Generate and store embedding
+                    # Generate embedding
                     embedding = self.generate_embedding(content)
                     if embedding:
-                        self.store_embedding(prompt_name, 'default', embedding, content_hash)
+                        entries.append((prompt_name, 'default', embedding, content_hash))
             except Exception:
                 pass  # Silent fail on auto-index
         
@@ -241,16 +247,21 @@ class EmbeddingsManager:
             cursor.execute("SELECT name, content FROM custom_prompts")
             for name, content in cursor.fetchall():
                 try:
-                    content_hash = hashlib.sha256(content.encode()).hexdigest()[:16]
+                    content_hash = hashlib.blake2b(content.encode(), digest_size=8).hexdigest()
                     embedding = self.generate_embedding(content)
                     if embedding:
-                        self.store_embedding(name, 'custom', embedding, content_hash)
+                        entries.append((name, 'custom', embedding, content_hash))
                 except Exception:
                     pass  # Silent fail on auto-index
         except Exception:
             pass  # Table might not exist yet
         
         conn.close()
+        
+        try:
+            self.store_embeddings(entries)
+        except Exception:
+            pass  # Silent fail on auto-index
 
 
 # Global instance
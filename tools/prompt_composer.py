@@ -6,19 +6,60 @@ Intelligent prompt composition and management tools.
 Helps combine, deduplicate, and optimize prompts for context efficiency.
 """
 
+import copy
+import functools
+import hashlib
 import json
+import os
 import re
 import sqlite3
-from typing import List, Optional
-from collections import OrderedDict
+from typing import Iterator, List, Optional
 
-from fastmcp import FastMCP
 try:
-    from .prompt_registry import load_prompts, estimate_tokens, init_db, DB_PATH
+    from ._mcp import mcp
+    from .prompt_registry import load_prompts, estimate_tokens, tokens_for_length, init_db, connect_db, default_prompts, _load_prompts, _log_usage_many
 except ImportError:
-    from prompt_registry import load_prompts, estimate_tokens, init_db, DB_PATH
+    from _mcp import mcp
+    from prompt_registry import load_prompts, estimate_tokens, tokens_for_length, init_db, connect_db, default_prompts, _load_prompts, _log_usage_many
 
-mcp = FastMCP()
+# Blank-line boundary between paragraphs
+PARAGRAPH_SPLIT = re.compile(r'\n\s*\n')
+
+# Default prompts with categories, as reported by list_available.
+# Shared across calls, so treat it as read-only.
+_DEFAULTS = {
+    "principles": {
+        "axioms": [
+            {"name": "ask_plan_act", "description": "Core Ask→Plan→Act methodology", "path": "principles/axioms/CORE.md"},
+            {"name": "quality_axioms", "description": "Quality and best practices", "path": "principles/axioms/QUALITY.md"},
+            {"name": "patterns", "description": "Meta-patterns for prompt design", "path": "principles/axioms/PATTERNS.md"}
+        ],
+        "patterns": [
+            {"name": "safe_coding", "description": "Safe coding practices", "path": "principles/patterns/safe_coding.md"},
+            {"name": "context_economy", "description": "Context-aware prompt loading", "path": "principles/patterns/context_economy.md"},
+            {"name": "echo_emoji", "description": "Echo-emoji contract pattern", "path": "principles/patterns/echo_emoji.md"},
+            {"name": "debugging_methodology", "description": "Systematic debugging approach", "path": "principles/patterns/debugging_methodology.md"},
+            {"name": "code_review", "description": "Comprehensive code review checklist", "path": "principles/patterns/code_review.md"},
+            {"name": "documentation", "description": "Documentation best practices", "path": "principles/patterns/documentation.md"},
+            {"name": "testing_strategy", "description": "Test-driven development guide", "path": "principles/patterns/testing_strategy.md"}
+        ]
+    },
+    "workflows": {
+        "documentation": [
+            {"name": "update_docs", "description": "Update documentation after completing work", "path": "workflows/documentation/update_docs.md"}
+        ]
+    },
+    "meta": [
+        {"name": "implementation_guide", "description": "Implementation planning"},
+        {"name": "design_rationale", "description": "Design decisions and rationale"}
+    ]
+}
+
+# Count defaults once at import
+_DEFAULTS_TOTAL = sum(
+    sum(len(sub) for sub in content.values()) if isinstance(content, dict) else len(content)
+    for content in _DEFAULTS.values()
+)
 
 @mcp.tool()
 def compose_prompts(
@@ -38,22 +79,98 @@ def compose_prompts(
     
     Returns:
         dict: Composed prompt with metadata
+    
+    Compositions built purely from files (default prompts and file: refs) are
+    cached until one of those files changes; cache hits still log usage.
+    """
+    cache_key = _compose_cache_key(prompt_refs)
+    if cache_key is None:
+        result, usage = _compose(prompt_refs, deduplicate, max_tokens, separator)
+    else:
+        result, usage = _compose_cached(
+            tuple(prompt_refs), deduplicate, max_tokens, separator, cache_key
+        )
+        # Callers get their own copy so they cannot mutate the cached entry
+        result = copy.deepcopy(result)
+    
+    # Logged here rather than while loading, so cache hits are counted too
+    if usage:
+        init_db()
+        conn = connect_db()
+        try:
+            _log_usage_many(usage, conn)
+            conn.commit()
+        finally:
+            conn.close()
+    return result
+
+@functools.lru_cache(maxsize=64)
+def _compose_cached(
+    refs: tuple,
+    deduplicate: bool,
+    max_tokens: Optional[int],
+    separator: str,
+    cache_key: tuple
+) -> tuple:
+    """Compose file-backed prompts; cache_key pins the files' stat results."""
+    return _compose(list(refs), deduplicate, max_tokens, separator)
+
+def _compose_cache_key(prompt_refs: List[str]) -> Optional[tuple]:
+    """
+    Fingerprint the files behind prompt_refs, or None if any ref is not
+    file-backed (custom prompts live in the database) or cannot be stat'ed.
+    """
+    key = []
+    for ref in prompt_refs:
+        if ref.startswith("file:"):
+            path = ref[5:]
+        elif ref.startswith("shippopotamus:"):
+            path = default_prompts.get(ref[14:])
+        elif ref.startswith("custom:"):
+            return None
+        else:
+            path = default_prompts.get(ref)
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key.append((ref, os.path.abspath(path), stat.st_mtime_ns, stat.st_size))
+    return tuple(key)
+
+def _compose(
+    prompt_refs: List[str],
+    deduplicate: bool,
+    max_tokens: Optional[int],
+    separator: str
+) -> tuple:
+    """
+    Load and compose prompts (uncached body of compose_prompts). Returns the
+    result and the usage entries to log, which are left to the caller.
     """
     # First load all prompts
-    loaded_result = load_prompts(prompt_refs)
+    init_db()
+    conn = connect_db()
+    try:
+        loaded_result, usage = _load_prompts(prompt_refs, conn)
+    finally:
+        conn.close()
+    usage = tuple(usage)
     
     if not loaded_result["loaded"]:
         return {
             "error": "No prompts could be loaded",
             "errors": loaded_result["errors"]
-        }
+        }, usage
     
     # Extract contents
     contents = []
     metadata = {
         "sources": [],
         "total_original_tokens": 0,
-        "removed_duplicates": []
+        "removed_duplicates": [],
+        "removed_tokens": 0
     }
     
     for prompt in loaded_result["loaded"]:
@@ -65,22 +182,23 @@ def compose_prompts(
         })
         metadata["total_original_tokens"] += prompt["tokens"]
     
-    # Compose the content
-    if deduplicate:
-        composed_content, duplicates = deduplicate_content(contents, separator)
-        metadata["removed_duplicates"] = duplicates
-    else:
-        composed_content = separator.join(contents)
-    
-    # Check token budget
-    composed_tokens = estimate_tokens(composed_content)
-    
-    if max_tokens and composed_tokens > max_tokens:
-        # Trim to fit budget
-        composed_content, metadata["trimmed"] = trim_to_budget(
-            contents, max_tokens, separator
-        )
-        composed_tokens = estimate_tokens(composed_content)
+    # Compose in a single pass: split, dedupe and budget each paragraph once
+    pieces = []
+    composed_chars = 0
+    previous_index = None
+    for index, paragraph in _compose_stream(contents, deduplicate, max_tokens, separator, metadata):
+        if previous_index is not None:
+            joiner = "\n\n" if index == previous_index else separator
+            pieces.append(joiner)
+            composed_chars += len(joiner)
+        pieces.append(paragraph)
+        composed_chars += len(paragraph)
+        previous_index = index
+    composed_content = "".join(pieces)
+    
+    # Tokens come from the emitted length, so stripped whitespace and
+    # collapsed blank lines are accounted for and no paragraph is re-measured
+    composed_tokens = tokens_for_length(composed_chars)
     
     return {
         "content": composed_content,
@@ -88,7 +206,7 @@ def compose_prompts(
         "metadata": metadata,
         "sources": loaded_result["loaded"],
         "errors": loaded_result["errors"]
-    }
+    }, usage
 
 @mcp.tool()
 def list_available(
@@ -117,44 +235,13 @@ def list_available(
     
     # Default prompts with categories
     if include_defaults:
-        result["defaults"] = {
-            "principles": {
-                "axioms": [
-                    {"name": "ask_plan_act", "description": "Core Ask→Plan→Act methodology", "path": "principles/axioms/CORE.md"},
-                    {"name": "quality_axioms", "description": "Quality and best practices", "path": "principles/axioms/QUALITY.md"},
-                    {"name": "patterns", "description": "Meta-patterns for prompt design", "path": "principles/axioms/PATTERNS.md"}
-                ],
-                "patterns": [
-                    {"name": "safe_coding", "description": "Safe coding practices", "path": "principles/patterns/safe_coding.md"},
-                    {"name": "context_economy", "description": "Context-aware prompt loading", "path": "principles/patterns/context_economy.md"},
-                    {"name": "echo_emoji", "description": "Echo-emoji contract pattern", "path": "principles/patterns/echo_emoji.md"},
-                    {"name": "debugging_methodology", "description": "Systematic debugging approach", "path": "principles/patterns/debugging_methodology.md"},
-                    {"name": "code_review", "description": "Comprehensive code review checklist", "path": "principles/patterns/code_review.md"},
-                    {"name": "documentation", "description": "Documentation best practices", "path": "principles/patterns/documentation.md"},
-                    {"name": "testing_strategy", "description": "Test-driven development guide", "path": "principles/patterns/testing_strategy.md"}
-                ]
-            },
-            "workflows": {
-                "documentation": [
-                    {"name": "update_docs", "description": "Update documentation after completing work", "path": "workflows/documentation/update_docs.md"}
-                ]
-            },
-            "meta": [
-                {"name": "implementation_guide", "description": "Implementation planning"},
-                {"name": "design_rationale", "description": "Design decisions and rationale"}
-            ]
-        }
-        # Count defaults
-        for category, content in result["defaults"].items():
-            if isinstance(content, dict):  # principles and workflows
-                for subcategory in content.values():
-                    result["total"] += len(subcategory)
-            else:  # meta
-                result["total"] += len(content)
+        result["defaults"] = _DEFAULTS
+        result["total"] += _DEFAULTS_TOTAL
     
     # Custom prompts
     if include_custom:
-        conn = sqlite3.connect(DB_PATH)
+        conn = connect_db()
+        conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         
         query = """
@@ -173,24 +260,27 @@ def list_available(
         
         query += " ORDER BY usage_count DESC, updated_at DESC"
         
+        cursor.arraysize = 128
         cursor.execute(query, params)
         
-        for row in cursor.fetchall():
-            name, tags_json, created, updated, usage, tokens = row
-            result["custom"].append({
-                "name": name,
-                "tags": json.loads(tags_json),
-                "created_at": created,
-                "updated_at": updated,
-                "usage_count": usage,
-                "tokens": tokens
-            })
+        # Stream rows in batches rather than materializing them all at once
+        while True:
+            batch = cursor.fetchmany()
+            if not batch:
+                break
+            result["custom"].extend(_custom_row_to_dict(row) for row in batch)
         
         conn.close()
         result["total"] += len(result["custom"])
     
     return result
 
+def _custom_row_to_dict(row: sqlite3.Row) -> dict:
+    """Convert a custom_prompts listing row into its result dict."""
+    item = dict(row)
+    item["tags"] = json.loads(item["tags"])
+    return item
+
 @mcp.tool()
 def estimate_context(
     content: Optional[str] = None,
@@ -244,47 +334,72 @@ def estimate_context(
         "recommendations": get_token_recommendations(total_tokens)
     }
 
-def deduplicate_content(contents: List[str], separator: str) -> tuple[str, List[str]]:
-    """Remove duplicate paragraphs while preserving order."""
-    seen_paragraphs = OrderedDict()
-    duplicates = []
-    
-    for content in contents:
-        # Split into paragraphs
-        paragraphs = [p.strip() for p in re.split(r'\n\s*\n', content) if p.strip()]
+def _compose_stream(
+    contents: List[str],
+    deduplicate: bool,
+    max_tokens: Optional[int],
+    separator: str,
+    metadata: dict
+) -> Iterator[tuple[int, str]]:
+    """
+    Yield (source_index, paragraph) pairs in order, deduplicating and
+    budgeting as we go. Duplicates (and their tokens) and trimming are
+    recorded in metadata.
+    
+    Once a paragraph does not fit the budget, the rest of its source is
+    dropped and later (smaller) sources are still tried, so earlier prompts
+    keep priority without one large prompt crowding out everything after it.
+    """
+    seen: set[bytes] = set()
+    # Budget on the cumulative length, joiners included, so rounding happens
+    # once and matches estimate_tokens on the composed content
+    running_chars = 0
+    budgeted = max_tokens is not None and max_tokens > 0
+    kept_sources = set()
+    cut_sources = set()
+    previous_index = None
+    
+    for index, content in enumerate(contents):
+        # Without dedupe there is nothing to compare, so keep each prompt whole
+        if deduplicate:
+            paragraphs = [p.strip() for p in PARAGRAPH_SPLIT.split(content) if p.strip()]
+        else:
+            paragraphs = [content]
         
         for para in paragraphs:
-            # Normalize whitespace for comparison
-            normalized = ' '.join(para.split())
+            if deduplicate:
+                # Normalize whitespace for comparison
+                normalized = ' '.join(para.split())
+                key = hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+                if key in seen:
+                    metadata["removed_duplicates"].append(para[:50] + "...")
+                    metadata["removed_tokens"] += estimate_tokens(para)
+                    continue
             
-            if normalized not in seen_paragraphs:
-                seen_paragraphs[normalized] = para
+            if previous_index is None:
+                joiner_chars = 0
+            elif index == previous_index:
+                joiner_chars = len("\n\n")
             else:
-                duplicates.append(para[:50] + "...")
-    
-    # Reconstruct with original formatting
-    unique_paragraphs = list(seen_paragraphs.values())
-    return '\n\n'.join(unique_paragraphs), duplicates
-
-def trim_to_budget(contents: List[str], max_tokens: int, separator: str) -> tuple[str, dict]:
-    """Trim content to fit token budget."""
-    trimmed = []
-    current_tokens = 0
-    trimmed_info = {
-        "kept_prompts": 0,
-        "dropped_prompts": 0
-    }
-    
-    for content in contents:
-        content_tokens = estimate_tokens(content)
-        if current_tokens + content_tokens <= max_tokens:
-            trimmed.append(content)
-            current_tokens += content_tokens
-            trimmed_info["kept_prompts"] += 1
-        else:
-            trimmed_info["dropped_prompts"] += 1
-    
-    return separator.join(trimmed), trimmed_info
+                joiner_chars = len(separator)
+            if budgeted and tokens_for_length(running_chars + joiner_chars + len(para)) > max_tokens:
+                cut_sources.add(index)
+                break
+            running_chars += joiner_chars + len(para)
+            
+            if deduplicate:
+                # Only kept paragraphs count as seen; dropped text never made it out
+                seen.add(key)
+            kept_sources.add(index)
+            previous_index = index
+            yield index, para
+    
+    if cut_sources:
+        metadata["trimmed"] = {
+            "kept_prompts": len(kept_sources),
+            "dropped_prompts": len(cut_sources - kept_sources),
+            "kept_tokens": tokens_for_length(running_chars)
+        }
 
 def get_token_recommendations(tokens: int) -> List[str]:
     """Get recommendations based on token count."""
@@ -302,6 +417,14 @@ def get_token_recommendations(tokens: int) -> List[str]:
     
     return recommendations
 
+# Capability blurb for each starter prompt loaded by bootstrap_session
+_STARTER_CAPABILITIES = {
+    "ask_plan_act": "• Ask→Plan→Act methodology for structured problem solving",
+    "quality_axioms": "• Quality principles for robust implementations",
+    "context_economy": "• Context-aware loading to optimize token usage",
+    "safe_coding": "• Security best practices for safe code generation"
+}
+
 @mcp.tool()
 def bootstrap_session() -> dict:
     """
@@ -344,14 +467,9 @@ def bootstrap_session() -> dict:
         loaded_prompts.append(f"✓ {ref}")
         
         # Add capability descriptions
-        if ref == "ask_plan_act":
-            capabilities.append("• Ask→Plan→Act methodology for structured problem solving")
-        elif ref == "quality_axioms":
-            capabilities.append("• Quality principles for robust implementations")
-        elif ref == "context_economy":
-            capabilities.append("• Context-aware loading to optimize token usage")
-        elif ref == "safe_coding":
-            capabilities.append("• Security best practices for safe code generation")
+        capability = _STARTER_CAPABILITIES.get(ref)
+        if capability:
+            capabilities.append(capability)
     
     quick_reference = {
         "core_tools": [
@@ -7,29 +7,109 @@ Manages both default prompts (from our curated library) and custom prompts (user
 """
 
 import json
+import os
 import sqlite3
 from pathlib import Path
 from typing import Dict, List, Optional
 from datetime import datetime
+import functools
 import hashlib
+import time
 
-from fastmcp import FastMCP
-
-mcp = FastMCP()
+try:
+    from ._mcp import mcp
+except ImportError:
+    from _mcp import mcp
 
 # Database path in project's tmp directory
 DB_PATH = Path("tmp/prompt_registry.db")
 
-# Token estimation ratio (roughly 4 chars = 1 token)
+# Token estimation ratio (roughly 4 chars = 1 token). tokens_for_length
+# computes ceil(len * TOKEN_RATIO) as (len + 3) >> 2; update both together.
 TOKEN_RATIO = 0.25
 
+# Map of default prompt names to their file paths
+default_prompts = {
+    # Core methodologies (principles)
+    "ask_plan_act": "prompts/principles/axioms/CORE.md",
+    "quality_axioms": "prompts/principles/axioms/QUALITY.md", 
+    "patterns": "prompts/principles/axioms/PATTERNS.md",
+    
+    # Specific patterns (principles)
+    "safe_coding": "prompts/principles/patterns/safe_coding.md",
+    "context_economy": "prompts/principles/patterns/context_economy.md",
+    "echo_emoji": "prompts/principles/patterns/echo_emoji.md",
+    "debugging_methodology": "prompts/principles/patterns/debugging_methodology.md",
+    "code_review": "prompts/principles/patterns/code_review.md",
+    "documentation": "prompts/principles/patterns/documentation.md",
+    "testing_strategy": "prompts/principles/patterns/testing_strategy.md",
+    
+    # Workflows
+    "update_docs": "prompts/workflows/documentation/update_docs.md",
+    
+    # Meta prompts
+    "implementation_guide": "prompts/meta/implementation-plan.md",
+    "design_rationale": "prompts/meta/design-rationale.md"
+}
+
+# Custom prompt lookup by name; the UNIQUE constraint on name gives it an index
+_SELECT_CUSTOM_BY_NAME = """
+    SELECT name, content, file_path, tags, parent_prompts,
+           created_at, updated_at, tokens
+    FROM custom_prompts
+    WHERE name = ?
+"""
+
+# Batched form for several names, filled in with one "?" per name
+_SELECT_CUSTOM_BY_NAMES = """
+    SELECT name, content, file_path, tags, parent_prompts,
+           created_at, updated_at, tokens
+    FROM custom_prompts
+    WHERE name IN ({placeholders})
+"""
+
+_INSERT_USAGE = """
+    INSERT INTO usage_log (prompt_name, prompt_type, used_at, tokens)
+    VALUES (?, ?, ?, ?)
+"""
+
+_BUMP_USAGE_COUNT = """
+    UPDATE custom_prompts 
+    SET usage_count = usage_count + 1
+    WHERE name = ?
+"""
+
+_CREATE_USAGE_LOG = """
+    CREATE TABLE IF NOT EXISTS usage_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        prompt_name TEXT NOT NULL,
+        prompt_type TEXT NOT NULL,  -- 'default', 'custom', 'file'
+        used_at REAL NOT NULL,  -- Unix epoch seconds
+        tokens INTEGER
+    )
+"""
+
+# Stay well under SQLite's bound-parameter limit
+_MAX_IN_PARAMS = 500
+
+# Set once the schema exists, so tool calls skip the mkdir and DDL round-trip
+_DB_READY = False
+
 def init_db():
-    """Initialize the prompt registry database."""
+    """Initialize the prompt registry database (once per process)."""
+    global _DB_READY
+    if _DB_READY:
+        return
+    
     DB_PATH.parent.mkdir(exist_ok=True)
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect_db()
     cursor = conn.cursor()
     
+    # WAL turns each usage-log commit into a sequential append; the journal
+    # mode is stored in the database file, so it only needs setting here
+    cursor.execute("PRAGMA journal_mode=WAL")
+    
     # Table for custom prompts metadata
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS custom_prompts (
@@ -48,57 +128,91 @@ def init_db():
     """)
     
     # Table for tracking prompt usage
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS usage_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            prompt_name TEXT NOT NULL,
-            prompt_type TEXT NOT NULL,  -- 'default', 'custom', 'file'
-            used_at TEXT NOT NULL,
-            tokens INTEGER
-        )
-    """)
+    cursor.execute(_CREATE_USAGE_LOG)
+    
+    # Databases created before used_at became epoch seconds hold ISO strings
+    columns = {row[1]: row[2] for row in cursor.execute("PRAGMA table_info(usage_log)")}
+    if columns.get("used_at") == "TEXT":
+        _migrate_usage_log_to_epoch(cursor)
     
     conn.commit()
     conn.close()
+    _DB_READY = True
+
+def _migrate_usage_log_to_epoch(cursor: sqlite3.Cursor):
+    """Rebuild a TEXT used_at column as REAL epoch seconds in one transaction."""
+    cursor.execute("BEGIN")
+    cursor.execute("ALTER TABLE usage_log RENAME TO usage_log_text")
+    cursor.execute(_CREATE_USAGE_LOG)
+    # ISO rows came from datetime.now(), i.e. local time; rows logged after
+    # the switch but before this migration are epoch seconds stored as text
+    cursor.execute("""
+        INSERT INTO usage_log (id, prompt_name, prompt_type, used_at, tokens)
+        SELECT id, prompt_name, prompt_type,
+               CASE WHEN used_at LIKE '____-__-__%'
+                    THEN (julianday(used_at, 'utc') - 2440587.5) * 86400.0
+                    ELSE CAST(used_at AS REAL)
+               END,
+               tokens
+        FROM usage_log_text
+    """)
+    cursor.execute("DROP TABLE usage_log_text")
+
+def connect_db() -> sqlite3.Connection:
+    """Open a registry connection with per-connection write tuning."""
+    conn = sqlite3.connect(DB_PATH)
+    # Under WAL, NORMAL only syncs at checkpoints and stays crash-safe
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def _reset_db():
+    """Forget that the database was initialized (e.g. after DB_PATH moves)."""
+    global _DB_READY
+    _DB_READY = False
 
 def estimate_tokens(text: str) -> int:
     """Estimate token count from text."""
-    return int(len(text) * TOKEN_RATIO)
+    return tokens_for_length(len(text))
+
+def tokens_for_length(length: int) -> int:
+    """Estimate token count for text of the given length."""
+    # ceil(length * TOKEN_RATIO) as integer arithmetic
+    return (length + 3) >> 2
+
+@functools.lru_cache(maxsize=128)
+def _read_cached(path_str: str, mtime_ns: int, size: int) -> str:
+    """Read a file; keyed on mtime and size so edits are picked up."""
+    return Path(path_str).read_text()
+
+def read_prompt_file(file_path) -> str:
+    """Read a prompt file, reusing the last read while it is unchanged."""
+    path_str = os.path.abspath(file_path)
+    stat = os.stat(path_str)
+    return _read_cached(path_str, stat.st_mtime_ns, stat.st_size)
+
+@functools.lru_cache(maxsize=None)
+def _resolve_default(name: str) -> Optional[Path]:
+    """Resolve a known default prompt name to its file, checking existence once."""
+    file_path = Path(default_prompts[name])
+    if not file_path.exists():
+        return None
+    return file_path
 
 def get_default_prompt(name: str) -> Optional[Dict]:
     """Load a default prompt from our curated library."""
-    # Map of default prompt names to their file paths
-    default_prompts = {
-        # Core methodologies (principles)
-        "ask_plan_act": "prompts/principles/axioms/CORE.md",
-        "quality_axioms": "prompts/principles/axioms/QUALITY.md", 
-        "patterns": "prompts/principles/axioms/PATTERNS.md",
-        
-        # Specific patterns (principles)
-        "safe_coding": "prompts/principles/patterns/safe_coding.md",
-        "context_economy": "prompts/principles/patterns/context_economy.md",
-        "echo_emoji": "prompts/principles/patterns/echo_emoji.md",
-        "debugging_methodology": "prompts/principles/patterns/debugging_methodology.md",
-        "code_review": "prompts/principles/patterns/code_review.md",
-        "documentation": "prompts/principles/patterns/documentation.md",
-        "testing_strategy": "prompts/principles/patterns/testing_strategy.md",
-        
-        # Workflows
-        "update_docs": "prompts/workflows/documentation/update_docs.md",
-        
-        # Meta prompts
-        "implementation_guide": "prompts/meta/implementation-plan.md",
-        "design_rationale": "prompts/meta/design-rationale.md"
-    }
-    
+    # Checked before the cache so custom names and typos never become entries
     if name not in default_prompts:
         return None
     
-    file_path = Path(default_prompts[name])
-    if not file_path.exists():
+    file_path = _resolve_default(name)
+    if file_path is None:
         return None
     
-    content = file_path.read_text()
+    try:
+        content = read_prompt_file(file_path)
+    except OSError:
+        # Removed since it was resolved
+        return None
     return {
         "name": name,
         "content": content,
@@ -120,54 +234,68 @@ def get_prompt(name: str) -> dict:
     """
     init_db()
     
+    conn = connect_db()
+    try:
+        result = _get_prompt_with_conn(name, conn)
+        conn.commit()
+    finally:
+        conn.close()
+    return result
+
+def _get_prompt_with_conn(name: str, conn: sqlite3.Connection) -> dict:
+    """get_prompt body; usage is logged on conn and left for the caller to commit."""
     # First check default prompts
     default = get_default_prompt(name)
     if default:
         # Log usage
-        log_usage(name, "default", default["tokens"])
+        log_usage(name, "default", default["tokens"], conn=conn)
         return default
     
     # Then check custom prompts
-    conn = sqlite3.connect(DB_PATH)
+    rows = _fetch_custom_rows([name], conn)
+    prompt = _custom_prompt_from_row(name, rows.get(name))
+    if "error" not in prompt:
+        log_usage(prompt["name"], "custom", prompt["tokens"], conn=conn)
+    return prompt
+
+def _fetch_custom_rows(names: List[str], conn: sqlite3.Connection) -> Dict[str, sqlite3.Row]:
+    """Fetch custom_prompts rows for names with batched IN queries, keyed by name."""
+    names = list(dict.fromkeys(names))
     cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT name, content, file_path, tags, parent_prompts, 
-               created_at, updated_at, tokens, hash
-        FROM custom_prompts
-        WHERE name = ?
-    """, (name,))
-    
-    row = cursor.fetchone()
-    conn.close()
-    
-    if not row:
+    cursor.row_factory = sqlite3.Row
+    
+    rows = {}
+    for start in range(0, len(names), _MAX_IN_PARAMS):
+        batch = names[start:start + _MAX_IN_PARAMS]
+        if len(batch) == 1:
+            # Fixed text, so single lookups (get_prompt) reuse the cached statement
+            sql = _SELECT_CUSTOM_BY_NAME
+        else:
+            sql = _SELECT_CUSTOM_BY_NAMES.format(placeholders=",".join("?" * len(batch)))
+        cursor.execute(sql, batch)
+        for row in cursor.fetchall():
+            rows[row["name"]] = row
+    return rows
+
+def _custom_prompt_from_row(name: str, row: Optional[sqlite3.Row]) -> dict:
+    """Build a custom prompt result from its row (or the not-found error)."""
+    if row is None:
         return {"error": f"Prompt '{name}' not found in registry"}
     
-    name, content, file_path, tags_json, parents_json, created, updated, tokens, hash_val = row
+    prompt = dict(row)
+    prompt["type"] = "custom"
     
     # If it's a file reference, load from file
-    if file_path and not content:
+    if prompt["file_path"] and not prompt["content"]:
         try:
-            content = Path(file_path).read_text()
-            tokens = estimate_tokens(content)
+            prompt["content"] = read_prompt_file(prompt["file_path"])
+            prompt["tokens"] = estimate_tokens(prompt["content"])
         except Exception as e:
-            return {"error": f"Failed to load file '{file_path}': {str(e)}"}
+            return {"error": f"Failed to load file '{prompt['file_path']}': {str(e)}"}
     
-    # Log usage
-    log_usage(name, "custom", tokens)
-    
-    return {
-        "name": name,
-        "content": content,
-        "type": "custom",
-        "file_path": file_path,
-        "tags": json.loads(tags_json),
-        "parent_prompts": json.loads(parents_json),
-        "created_at": created,
-        "updated_at": updated,
-        "tokens": tokens
-    }
+    prompt["tags"] = json.loads(prompt["tags"])
+    prompt["parent_prompts"] = json.loads(prompt["parent_prompts"])
+    return prompt
 
 @mcp.tool()
 def save_prompt(
@@ -201,13 +329,14 @@ def save_prompt(
     # Calculate tokens and hash
     if content:
         tokens = estimate_tokens(content)
-        hash_val = hashlib.sha256(content.encode()).hexdigest()[:16]
+        # Change-detection digest, not a security boundary: 64-bit BLAKE2b
+        hash_val = hashlib.blake2b(content.encode(), digest_size=8).hexdigest()
     else:
         # For file references, we'll calculate on load
         tokens = None
         hash_val = None
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect_db()
     cursor = conn.cursor()
     
     now = datetime.now().isoformat()
@@ -223,8 +352,8 @@ def save_prompt(
             name,
             content,
             file_path,
-            json.dumps(tags or []),
-            json.dumps(parent_prompts or []),
+            json.dumps(tags or [], separators=(",", ":")),
+            json.dumps(parent_prompts or [], separators=(",", ":")),
             now,
             now,
             tokens,
@@ -264,16 +393,42 @@ def load_prompts(prompt_refs: List[str]) -> dict:
     """
     init_db()
     
+    # One connection for every lookup and usage log in this call
+    conn = connect_db()
+    try:
+        result, usage = _load_prompts(prompt_refs, conn)
+        _log_usage_many(usage, conn)
+        conn.commit()
+    finally:
+        conn.close()
+    return result
+
+def _load_prompts(prompt_refs: List[str], conn: sqlite3.Connection) -> tuple:
+    """load_prompts body; returns (result, usage entries) without logging them."""
     loaded = []
     errors = []
     total_tokens = 0
     
+    # Defaults win over custom prompts; the remaining names are fetched
+    # from custom_prompts in one batched query
+    registry_refs = {}
+    for ref in prompt_refs:
+        if ref.startswith("file:") or ref.startswith("shippopotamus:"):
+            continue
+        name = ref[7:] if ref.startswith("custom:") else ref  # Remove prefix
+        registry_refs[ref] = (name, get_default_prompt(name))
+    custom_rows = _fetch_custom_rows(
+        [name for name, default in registry_refs.values() if default is None],
+        conn
+    )
+    
+    usage = []
     for ref in prompt_refs:
         if ref.startswith("file:"):
             # Load from file
             file_path = ref[5:]  # Remove "file:" prefix
             try:
-                content = Path(file_path).read_text()
+                content = read_prompt_file(file_path)
                 tokens = estimate_tokens(content)
                 loaded.append({
                     "ref": ref,
@@ -283,7 +438,7 @@ def load_prompts(prompt_refs: List[str]) -> dict:
                     "tokens": tokens
                 })
                 total_tokens += tokens
-                log_usage(file_path, "file", tokens)
+                usage.append((file_path, "file", tokens))
             except Exception as e:
                 errors.append({
                     "ref": ref,
@@ -300,32 +455,23 @@ def load_prompts(prompt_refs: List[str]) -> dict:
                     **prompt
                 })
                 total_tokens += prompt["tokens"]
-                log_usage(name, "default", prompt["tokens"])
+                usage.append((name, "default", prompt["tokens"]))
             else:
                 errors.append({
                     "ref": ref,
                     "error": f"Default prompt '{name}' not found"
                 })
                 
-        elif ref.startswith("custom:"):
-            # Explicitly load custom prompt
-            name = ref[7:]  # Remove prefix
-            result = get_prompt(name)
-            if "error" not in result:
-                loaded.append({
-                    "ref": ref,
-                    **result
-                })
-                total_tokens += result["tokens"]
-            else:
-                errors.append({
-                    "ref": ref,
-                    "error": result["error"]
-                })
-                
         else:
-            # Try registry (default first, then custom)
-            result = get_prompt(ref)
+            # Registry or "custom:" prefix (default first, then custom)
+            name, result = registry_refs[ref]
+            if result:
+                usage.append((name, "default", result["tokens"]))
+            else:
+                result = _custom_prompt_from_row(name, custom_rows.get(name))
+                if "error" not in result:
+                    usage.append((result["name"], "custom", result["tokens"]))
+            
             if "error" not in result:
                 loaded.append({
                     "ref": ref,
@@ -344,25 +490,33 @@ def load_prompts(prompt_refs: List[str]) -> dict:
         "total_prompts": len(loaded),
         "total_tokens": total_tokens,
         "success_rate": f"{len(loaded)}/{len(prompt_refs)}"
-    }
+    }, usage
 
-def log_usage(name: str, prompt_type: str, tokens: int):
-    """Log prompt usage for analytics."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+def log_usage(name: str, prompt_type: str, tokens: int, conn: Optional[sqlite3.Connection] = None):
+    """
+    Log prompt usage for analytics.
     
-    cursor.execute("""
-        INSERT INTO usage_log (prompt_name, prompt_type, used_at, tokens)
-        VALUES (?, ?, ?, ?)
-    """, (name, prompt_type, datetime.now().isoformat(), tokens))
+    If conn is given the writes reuse it and the caller commits; otherwise a
+    connection is opened and committed here.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = connect_db()
     
-    # Update usage count for custom prompts
-    if prompt_type == "custom":
-        cursor.execute("""
-            UPDATE custom_prompts 
-            SET usage_count = usage_count + 1
-            WHERE name = ?
-        """, (name,))
+    _log_usage_many([(name, prompt_type, tokens)], conn)
     
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    if own_conn:
+        conn.commit()
+        conn.close()
+
+def _log_usage_many(entries: List[tuple], conn: sqlite3.Connection):
+    """Log (name, prompt_type, tokens) usages on conn without committing."""
+    used_at = time.time()
+    conn.executemany(_INSERT_USAGE, [
+        (name, prompt_type, used_at, tokens) for name, prompt_type, tokens in entries
+    ])
+    
+    # Update usage count for custom prompts
+    conn.executemany(_BUMP_USAGE_COUNT, [
+        (name,) for name, prompt_type, _ in entries if prompt_type == "custom"
+    ])